@@ -2,24 +2,91 @@
 # Copyright (c) 2013-2015, Kang Seonghoon.
 # See README.md and LICENSE.txt for details.
 
-import urllib
+import urllib.request
+import urllib.error
+import email.utils
+import shutil
+import hashlib
+import pickle
 import sys
+import array
 import os.path
 import re
 import heapq
+import bisect
+import itertools
+import operator
 import argparse
+import multiprocessing
+import zlib
 
 def open_index(path, comments):
-    for line in open(path):
-        line = line.strip()
-        if not line: continue
-        if line.startswith('#'):
-            comments.append('//' + line[1:])
-            continue
-        parts = line.split(None, 2)
-        key = int(parts[0], 0)
-        value = int(parts[1], 0)
-        yield key, value
+    entries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line: continue
+            if line.startswith('#'):
+                comments.append('//' + line[1:])
+                continue
+            parts = line.split(None, 2)
+            entries.append((int(parts[0], 0), int(parts[1], 0)))
+    return entries
+
+# in seconds; a stalled connection shouldn't block a run that can use the cache
+FETCH_TIMEOUT = 10
+
+def fetch_index(opts, name, cached_path):
+    # downloads the index into `cached_path` unless the cached copy is still fresh.
+    # returns True if the cached copy has been (re)used.
+    url = 'http://encoding.spec.whatwg.org/index-%s.txt' % name
+    etag_path = cached_path + '.etag'
+    cached = not opts.flush_cache and os.path.exists(cached_path)
+
+    req = urllib.request.Request(url)
+    if cached:
+        mtime = os.path.getmtime(cached_path)
+        req.add_header('If-Modified-Since', email.utils.formatdate(mtime, usegmt=True))
+        if os.path.exists(etag_path):
+            with open(etag_path) as f:
+                req.add_header('If-None-Match', f.read().strip())
+    # once the network turns out to be unreachable, other cached indices are used as is
+    if cached and opts.offline: return True
+    try:
+        resp = urllib.request.urlopen(req, timeout=FETCH_TIMEOUT)
+    except urllib.error.HTTPError:
+        if cached: return True # not modified, or the server is failing; keep the cached copy
+        raise
+    except OSError: # URLError and socket.timeout
+        opts.offline = True
+        if cached: return True # offline, keep using the cached copy
+        raise
+
+    with resp:
+        # write to a temporary file first so that an interrupted download
+        # never leaves a truncated cache behind
+        tmp_path = cached_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(resp, f)
+            os.replace(tmp_path, cached_path)
+        except Exception:
+            try: os.unlink(tmp_path)
+            except OSError: pass
+            if cached: return True # the download was cut off, keep the cached copy
+            raise
+
+        etag = resp.info().get('ETag')
+        lastmod = resp.info().get('Last-Modified')
+    if etag:
+        with open(etag_path, 'w') as f:
+            f.write(etag)
+    elif os.path.exists(etag_path):
+        os.unlink(etag_path)
+    if lastmod:
+        mtime = email.utils.mktime_tz(email.utils.parsedate_tz(lastmod))
+        os.utime(cached_path, (mtime, mtime))
+    return False
 
 def read_index(opts, crate, name, comments):
     dirname = os.path.join(os.path.dirname(__file__), crate)
@@ -29,16 +96,8 @@ def read_index(opts, crate, name, comments):
     try: os.mkdir(opts.cache_dir)
     except OSError: pass
     cached_path = os.path.join(opts.cache_dir, '%s.txt' % name)
-    if not opts.flush_cache and os.path.exists(cached_path):
-        print >>sys.stderr, '(cached)',
-    else:
-        try:
-            urllib.urlretrieve('http://encoding.spec.whatwg.org/index-%s.txt' % name,
-                               cached_path)
-        except Exception:
-            try: os.unlink(cached_path)
-            except OSError: pass
-            raise
+    if fetch_index(opts, name, cached_path):
+        print('(cached)', end=' ', file=sys.stderr)
 
     return open_index(cached_path, comments)
 
@@ -48,16 +107,16 @@ def mkdir_and_open(crate, name):
         os.mkdir(dirname)
     except Exception:
         pass
-    return open(os.path.join(dirname, '%s.rs' % name.replace('-', '_')), 'wb')
+    return open(os.path.join(dirname, '%s.rs' % name.replace('-', '_')), 'w', 1<<20,
+                encoding='utf-8', newline='\n')
 
 def dedent(s):
     return re.sub(r'(?m)^\s*\|?', '', s)
 
 def write_header(f, name, comments):
-    print >>f, '// AUTOGENERATED FROM index-%s.txt, ORIGINAL COMMENT FOLLOWS:' % name
-    print >>f, '//'
-    for line in comments:
-        print >>f, line
+    f.write('// AUTOGENERATED FROM index-%s.txt, ORIGINAL COMMENT FOLLOWS:\n' % name)
+    f.write('//\n')
+    f.write(''.join(line + '\n' for line in comments))
 
 def write_fmt(f, args, fmt_or_cond, thenfmt=None, elsefmt=None, **kwargs):
     if thenfmt is not None:
@@ -69,18 +128,81 @@ def write_fmt(f, args, fmt_or_cond, thenfmt=None, elsefmt=None, **kwargs):
         f.write(dedent(fmt).format(**kwargs))
 
 def write_comma_separated(f, prefix, l, width=80):
-    buffered = ''
-    for i in l:
-        i = str(i)
-        if len(prefix) + len(buffered) + len(i) <= width:
-            buffered += i
-        else:
-            print >>f, prefix + buffered.rstrip()
-            buffered = i
-    if buffered:
-        print >>f, prefix + buffered.rstrip()
+    # writes items (followed by commas) packed into lines as many as possible.
+    # line breaks are found by bisecting the running total of item lengths,
+    # so the per-item work is done by C-level map/accumulate only.
+    l = list(map(str, l))
+    ends = list(itertools.accumulate(map(operator.add, map(len, l), itertools.repeat(2))))
+    avail = width - len(prefix)
+    lines = []
+    start = 0
+    while start < len(l):
+        base = ends[start - 1] if start > 0 else 0
+        end = bisect.bisect_right(ends, base + avail, start)
+        if end == start: end = start + 1 # an item exceeding the width gets its own line
+        lines.append(prefix + ', '.join(l[start:end]) + ',')
+        start = end
+    f.write(''.join(line + '\n' for line in lines))
+
+def uint_type(values):
+    # returns the smallest unsigned Rust integer type and its size for given values
+    if max(values) < 0x100: return 'u8', 1
+    assert max(values) < 0x10000
+    return 'u16', 2
+
+# tables larger than this (in bytes) are written as separate binary files
+BINARY_TABLE_THRESHOLD = 0x8000
+
+def use_binary_table(opts, values):
+    return not opts.text_tables and 2 * len(values) > BINARY_TABLE_THRESHOLD
+
+def binary_table_filename(name, tablename):
+    return '%s_%s.bin' % (name.replace('-', '_'), tablename.lower())
 
-def optimize_overlapping_blocks(blocks):
+def remove_binary_table(crate, name, tablename):
+    # removes a binary table left by an earlier run, which would be no longer referenced
+    path = os.path.join(os.path.dirname(__file__), crate, binary_table_filename(name, tablename))
+    if os.path.exists(path): os.unlink(path)
+
+def write_u16_table(f, crate, name, tablename, values, binary, attrs=''):
+    # writes a `u16` table with None mapped to X. binary tables are saved next to
+    # the generated source as little-endian `u16`s and included via include_bytes!,
+    # which is much cheaper for both the generator and rustc than the decimal
+    # literals; their entries should be read through `read_u16`.
+    if not binary:
+        remove_binary_table(crate, name, tablename)
+        f.write(attrs + "const %s: &'static [u16] = &[\n" % tablename)
+        write_comma_separated(f, '    ', ['X' if v is None else v for v in values])
+        f.write(']; // %d entries\n' % len(values))
+        return
+
+    filename = binary_table_filename(name, tablename)
+    blob = array.array('H', [0xffff if v is None else v for v in values])
+    if sys.byteorder != 'little': blob.byteswap()
+    with open(os.path.join(os.path.dirname(__file__), crate, filename), 'wb') as bf:
+        bf.write(blob.tobytes())
+    f.write(attrs + "const %s: &'static [u8; %d] = include_bytes!(\"%s\"); // %d entries\n" %
+            (tablename, 2 * len(values), filename, len(values)))
+
+    # the binary file can go stale or get corrupted independently from the source,
+    # so its CRC-32 is baked in and checked by a test.
+    write_fmt(f, {}, '''\
+       |
+       |{attrs}#[cfg(test)]
+       |#[test]
+       |fn test_{testname}_checksum() {{
+       |    let mut crc = !0u32;
+       |    for &b in {tablename}.iter() {{
+       |        crc ^= b as u32;
+       |        for _ in 0..8 {{ crc = (crc >> 1) ^ (0xedb88320 & 0u32.wrapping_sub(crc & 1)); }}
+       |    }}
+       |    assert_eq!(!crc, {crc:#010x});
+       |}}
+    ''',
+        attrs=attrs, tablename=tablename, testname=tablename.lower(),
+        crc=zlib.crc32(blob.tobytes()))
+
+def optimize_overlapping_blocks(blocks, itemsize):
     # let's imagine that there are three blocks of size 8:
     #     [X,X,1,2,3,X,X,X], [4,X,X,5,X,X,X,X], [X,X,X,X,X,X,X,6]
     # concatenating them as is results in size 24. however if we are
@@ -99,21 +221,26 @@ def optimize_overlapping_blocks(blocks):
     # is f(x,y). this is NP-hard as always with a cool algorithm (ugh).
     # we therefore stick to a simple greedy algorithm that
     # *always* pick the largest saving at that time.
+    #
+    # blocks are given as raw bytes of native integers with `itemsize` bytes
+    # each, where X is -1 (all bits set). every other value fits in 24 bits
+    # and thus has a zero most significant byte, so stripping 0xff bytes
+    # from either end and rounding down gives the exact number of X there.
 
     pregaps = []
     postgaps = []
     for idx, blk in enumerate(blocks):
-        assert any(x is not None for x in blk), 'no empty block allowed'
-        for i, v in enumerate(blk):
-            if v is not None: pregaps.append((-i, idx)); break
-        for i, v in enumerate(reversed(blk)):
-            if v is not None: postgaps.append((-i, idx)); break
+        pregap = (len(blk) - len(blk.lstrip(b'\xff'))) // itemsize
+        postgap = (len(blk) - len(blk.rstrip(b'\xff'))) // itemsize
+        assert pregap * itemsize < len(blk), 'no empty block allowed'
+        pregaps.append((-pregap, idx))
+        postgaps.append((-postgap, idx))
 
     heapq.heapify(pregaps)
     heapq.heapify(postgaps)
 
     # a simple disjoint-set data structure
-    group = [(i, 0) for i in xrange(len(blocks))] # (parent, rank)
+    group = [(i, 0) for i in range(len(blocks))] # (parent, rank)
     def get_group(i):
         parent, rank = group[i]
         if parent != i:
@@ -136,7 +263,7 @@ def optimize_overlapping_blocks(blocks):
 
     nextblk = {}
     prevblk = {}
-    for i in xrange(len(blocks)-1):
+    for i in range(len(blocks)-1):
         #      <-- postgap --->
         # -----================] preblk
         # postblk [============--------
@@ -166,47 +293,200 @@ def optimize_overlapping_blocks(blocks):
     assert len(ret) == len(blocks)
     return ret
 
-def make_minimal_trie(invdata, lowerlimit):
-    maxvalue = max(invdata) + 1
-    best = 0xffffffff
+def make_trie(args):
+    # builds a trie for given `triebits` out of the flattened invdata
+    # (see make_minimal_trie), or returns None if it exceeds `lowerlimit`.
+    #
+    # everything is kept as raw bytes of native integers (-1 for X) so that
+    # slicing, hashing, comparing and concatenating blocks all happen in C;
+    # the returned lower table is also in this form, and the upper table is
+    # an array of native unsigned integers.
+    triebits, flatbytes, lowerlimit = args
+    itemsize = array.array('i').itemsize
+    maxvalue = len(flatbytes) // itemsize
+
+    # the trailing padding is large enough to hold an entirely empty block.
+    blkbytes = itemsize << triebits
+    emptyblk = b'\xff' * blkbytes
+    flatbytes += emptyblk
+
+    # a dict keyed by the block bytes is already a hash table verified by
+    # memcmp, and filling it from a single comprehension keeps the per-block
+    # work out of the interpreter loop. setdefault evaluates `len(blockmap) - 1`
+    # before inserting, so each new block gets the next index while the empty
+    # block stays at -1.
+    blockmap = {emptyblk: -1}
+    upperidx = [blockmap.setdefault(flatbytes[i:i + blkbytes], len(blockmap) - 1)
+                for i in range(0, maxvalue * itemsize, blkbytes)]
+    del blockmap[emptyblk]
+
+    blocks = [None] * len(blockmap)
+    for blk, idx in blockmap.items():
+        blocks[idx] = blk
+
+    lower = bytearray(emptyblk)
+    uppermap = {-1: 0}
+    for idx, shift in optimize_overlapping_blocks(blocks, itemsize):
+        blk = blocks[idx]
+        shift *= itemsize
+        assert shift == 0 or lower[-shift:] == blk[:shift]
+        uppermap[idx] = (len(lower) - shift) // itemsize
+        lower += blk[shift:]
+    if len(lower) >= lowerlimit * itemsize: return None
+    upper = array.array('I', [uppermap[idx] for idx in upperidx])
+    return triebits, bytes(lower), upper
+
+# the flattened invdata shared by every task of a worker process,
+# so that it is pickled once per worker instead of once per task
+worker_flatbytes = None
+
+def init_trie_worker(flatbytes):
+    global worker_flatbytes
+    worker_flatbytes = flatbytes
+
+def make_trie_in_worker(args):
+    triebits, lowerlimit = args
+    return make_trie((triebits, worker_flatbytes, lowerlimit))
+
+# should be bumped whenever make_trie would give a different result for the same input
+TRIE_CACHE_VERSION = 2
+
+def make_minimal_trie(invdata, lowerlimit, jobs=1, cache_dir=None, flush_cache=False):
+    # flatten invdata once into native integers (-1 for unmapped), so that
+    # every block is a plain byte slice instead of `1<<triebits` dictionary
+    # lookups per candidate. each candidate is independent, so they can be
+    # distributed to `jobs` worker processes.
+    assert all(0 <= key < 0x1000000 for key in invdata.values())
+    flat = array.array('i', [-1]) * (max(invdata) + 1)
+    for value, key in invdata.items():
+        flat[value] = key
+    flatbytes = flat.tobytes()
+
+    # the result only depends on the flattened invdata and lowerlimit,
+    # so it is cached across runs unless the cache is being flushed.
+    if cache_dir is not None:
+        key = hashlib.sha256(b'%d:%d:%d:' % (TRIE_CACHE_VERSION, flat.itemsize, lowerlimit))
+        key.update(flatbytes)
+        cached_path = os.path.join(cache_dir, 'trie-%s.pkl' % key.hexdigest())
+        if not flush_cache and os.path.exists(cached_path):
+            with open(cached_path, 'rb') as f:
+                return pickle.load(f)
+
+    # the upper table has exactly `ceil(maxvalue / 2^triebits)` entries and
+    # the lower table holds at least one (empty) block, so this is a lower
+    # bound for the total size that can be checked without building a trie.
+    # the total size is roughly U-shaped in `triebits` and the minimum sits
+    # near the half of `log2(maxvalue)`, so candidates are tried from there
+    # outward to tighten `best` as early as possible.
+    maxvalue = len(flat)
+    def lower_bound(triebits):
+        return ((maxvalue + (1 << triebits) - 1) >> triebits) + (1 << triebits)
+    midpoint = maxvalue.bit_length() // 2
+    candidates = sorted((triebits for triebits in range(21) if (1 << triebits) < lowerlimit),
+                        key=lambda triebits: (abs(triebits - midpoint), triebits))
+
+    # ties are broken in favor of smaller `triebits`, as if they were tried
+    # in the ascending order.
+    best = (0xffffffff, 0)
     besttrie = None
-    for triebits in xrange(21):
-        blocks = []
-        upperidx = []
-        blockmap = {(None,) * (1<<triebits): -1}
-        for i in xrange(0, maxvalue, 1<<triebits):
-            blk = [invdata.get(j) for j in xrange(i, i + (1<<triebits))]
-            blockidx = blockmap.get(tuple(blk))
-            if blockidx is None:
-                blockidx = len(blocks)
-                blockmap[tuple(blk)] = blockidx
-                blocks.append(blk)
-            upperidx.append(blockidx)
-
-        lower = [None] * (1<<triebits)
-        uppermap = {-1: 0}
-        for idx, shift in optimize_overlapping_blocks(blocks):
-            blk = blocks[idx]
-            assert shift == 0 or lower[-shift:] == blk[:shift]
-            uppermap[idx] = len(lower) - shift
-            lower += blk[shift:]
-        upper = [uppermap[idx] for idx in upperidx]
-
-        if len(lower) < lowerlimit and best > len(lower) + len(upper):
-            best = len(lower) + len(upper)
-            besttrie = (triebits, lower, upper)
+    def update(trie):
+        nonlocal best, besttrie
+        if trie is None: return
+        triebits, lower, upper = trie
+        size = (len(lower) // flat.itemsize + len(upper), triebits)
+        if best > size:
+            best = size
+            besttrie = trie
+
+    # the candidate at the midpoint is built first to seed `best`, so that the bound
+    # prunes the remaining candidates even when they are handed to the workers.
+    update(make_trie((candidates[0], flatbytes, lowerlimit)))
+    candidates = [triebits for triebits in candidates[1:]
+                  if (lower_bound(triebits), triebits) < best]
+    if jobs > 1 and len(candidates) > 1:
+        # the bound can't be refined while the workers are running,
+        # so every remaining candidate is submitted at once.
+        tasks = [(triebits, lowerlimit) for triebits in candidates]
+        with multiprocessing.Pool(min(jobs, len(tasks)), init_trie_worker, (flatbytes,)) as pool:
+            for trie in pool.imap_unordered(make_trie_in_worker, tasks):
+                update(trie)
+    else:
+        for triebits in candidates:
+            if (lower_bound(triebits), triebits) >= best: continue
+            update(make_trie((triebits, flatbytes, lowerlimit)))
+
+    triebits, lower, upper = besttrie
+    lower = [None if v < 0 else v for v in array.array('i', lower)]
+    besttrie = triebits, lower, upper
+
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cached_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(besttrie, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cached_path)
     return besttrie
 
-def make_minimal_search(data, invdata, premap, maxsearch):
-    minkey = min(data)
+def make_dawg(invdata, nibbits=4):
+    # builds a minimized automaton reading `nibbits` bits of the code point at
+    # a time, most significant first. this is a trie of the fixed depth where
+    # every equal subtree is merged regardless of its alignment, so it tends to
+    # be smaller than the two-level trie when distant ranges share the layout.
+    #
+    # the last `nibbits` bits index the leaf blocks, which are built and
+    # overlapped exactly like the lower table of the two-level trie. each level
+    # above is then built by deduplicating groups of child offsets; the all-empty
+    # node is always present so that the groups can be padded with it.
+    # returns (nibbits, depth, transitions, values) where `transitions` holds the internal nodes in
+    # the breadth-first order (the root comes first) and each entry is either
+    # an offset into `transitions` or, at the last internal level, into `values`.
+    fanout = 1 << nibbits
+    flat = array.array('i', [-1]) * (max(invdata) + 1)
+    for value, key in invdata.items():
+        flat[value] = key
+    _, values, offsets = make_trie((nibbits, flat.tobytes(), 0xffffffff))
+
+    # the empty leaf block is always at the beginning, and so is the empty node
+    depth = 1
+    levels = []
+    while len(offsets) > 1 or not levels:
+        offsets.extend([0] * (-len(offsets) % fanout))
+        nodemap = {(0,) * fanout: 0}
+        nodeidx = [nodemap.setdefault(tuple(offsets[i:i + fanout]), len(nodemap))
+                   for i in range(0, len(offsets), fanout)]
+        nodes = [None] * len(nodemap)
+        for node, idx in nodemap.items():
+            nodes[idx] = node
+        levels.append(nodes)
+        offsets = nodeidx
+        depth += 1
+    # only the root is referenced at the top level
+    levels[-1] = [levels[-1][offsets[0]]]
+
+    # lay out the levels from the root, turning node indices into offsets
+    levels.reverse()
+    bases = [0]
+    for nodes in levels:
+        bases.append(bases[-1] + len(nodes) * fanout)
+    transitions = []
+    for i, nodes in enumerate(levels):
+        for node in nodes:
+            if i + 1 < len(levels):
+                transitions.extend(bases[i + 1] + child * fanout for child in node)
+            else:
+                transitions.extend(node)
+    values = [None if v < 0 else v for v in array.array('i', values)]
+    return nibbits, depth, transitions, values
+
+def make_minimal_search(premapped, minkey, invdata, premap, maxsearch):
     maxvalue = max(invdata) + 1
     best = 0xffffffff
     bestsearch = None
-    for searchbits in xrange(21):
+    for searchbits in range(21):
         lower = []
         upper = []
-        for i in xrange(0, maxvalue, 1<<searchbits):
-            v = sorted(premap(invdata[j]) for j in xrange(i, i+(1<<searchbits)) if j in invdata)
+        for i in range(0, maxvalue, 1<<searchbits):
+            v = sorted(premap(invdata[j]) for j in range(i, i+(1<<searchbits)) if j in invdata)
             if v:
                 w = sorted((y - x, j) for j, (x, y) in enumerate(zip(v, v[1:])))
                 count = v[-1] - v[0]
@@ -223,9 +503,9 @@ def make_minimal_search(data, invdata, premap, maxsearch):
                 # (s, e) when s >= 0x8000 is a single pair s.t. invdata[e] = s & 0x7fff
                 block = [(block[i] - minkey, block[i+1] - minkey + 1)
                             if block[i] < block[i+1] else
-                            (0x8000 | (block[i] - minkey), data[block[i]] & 0xffff)
-                         for i in xrange(0, len(block), 2)]
-                assert all(block[i] != block[i+1] for i in xrange(len(block) - 1))
+                            (0x8000 | (block[i] - minkey), premapped[block[i]] & 0xffff)
+                         for i in range(0, len(block), 2)]
+                assert all(block[i] != block[i+1] for i in range(len(block) - 1))
             else:
                 block = []
             upper.append(len(lower))
@@ -236,6 +516,44 @@ def make_minimal_search(data, invdata, premap, maxsearch):
             bestsearch = (searchbits, lower, upper)
     return bestsearch
 
+def fnv1a_hash(code, seed):
+    # 32-bit FNV-1a over the little-endian bytes of `code`, with a seeded basis.
+    # this should be kept in sync with `phf_hash` in the generated code.
+    h = 0x811c9dc5 ^ seed
+    for shift in (0, 8, 16, 24):
+        h = ((h ^ ((code >> shift) & 0xff)) * 0x01000193) & 0xffffffff
+    return h
+
+def make_perfect_hash(keys):
+    # builds a minimal-ish perfect hash with the CHD (hash, displace and compress)
+    # algorithm: keys are distributed to `1<<bucketbits` buckets by the top bits of
+    # an unseeded hash, and then each bucket, largest first, gets the first seed
+    # that sends all of its keys to distinct free slots among `1<<slotbits` slots.
+    # returns (slotbits, bucketbits, seeds, slots) where slots has None for vacancy.
+    slotbits = max(1, (len(keys) - 1).bit_length())
+    while True:
+        bucketbits = max(1, slotbits - 2)
+        buckets = [[] for _ in range(1 << bucketbits)]
+        for key in sorted(keys):
+            buckets[fnv1a_hash(key, 0) >> (32 - bucketbits)].append(key)
+
+        seeds = [0] * len(buckets)
+        slots = [None] * (1 << slotbits)
+        for b in sorted(range(len(buckets)), key=lambda b: (-len(buckets[b]), b)):
+            bucket = buckets[b]
+            if not bucket: continue
+            for seed in range(1, 0x10000):
+                pos = set(fnv1a_hash(key, seed) >> (32 - slotbits) for key in bucket)
+                if len(pos) == len(bucket) and all(slots[i] is None for i in pos): break
+            else:
+                break # no seed works, retry with more slots
+            seeds[b] = seed
+            for key in bucket:
+                slots[fnv1a_hash(key, seed) >> (32 - slotbits)] = key
+        else:
+            return slotbits, bucketbits, seeds, slots
+        slotbits += 1
+
 def generate_single_byte_index(opts, crate, name):
     data = [None] * 128
     invdata = {}
@@ -245,8 +563,15 @@ def generate_single_byte_index(opts, crate, name):
         data[key] = value
         invdata[value] = key
 
-    # generate a trie with a minimal amount of data
-    triebits, trielower, trieupper = make_minimal_trie(invdata, lowerlimit=0x10000)
+    if opts.phf_singlebyte:
+        # generate a perfect hash table instead of a trie
+        phfslotbits, phfbucketbits, phfseeds, phfslots = make_perfect_hash(invdata)
+    else:
+        # generate a trie with a minimal amount of data
+        triebits, trielower, trieupper = make_minimal_trie(invdata, lowerlimit=0x10000,
+                                                           jobs=opts.jobs,
+                                                           cache_dir=opts.cache_dir,
+                                                           flush_cache=opts.flush_cache)
 
     # generate a bitmap for quickly rejecting invalid chars even in the unoptimized setting
     bitlen = 0
@@ -263,11 +588,22 @@ def generate_single_byte_index(opts, crate, name):
         maxvalue=max(invdata),
         bitmap=bitmap,
         bitmapshift=bitmapshift,
-        triebits=triebits,
-        triemask=(1<<triebits)-1,
-        trielowersz=len(trielower),
-        trieuppersz=len(trieupper),
     )
+    if opts.phf_singlebyte:
+        args.update(
+            phfslotshift=32-phfslotbits,
+            phfslotsz=len(phfslots),
+            phfbucketshift=32-phfbucketbits,
+            phfbucketsz=len(phfseeds),
+        )
+    else:
+        args.update(
+            triebits=triebits,
+            triemask=(1<<triebits)-1,
+            trielowersz=len(trielower),
+            trieuppersz=len(trieupper),
+            trieuppertype=uint_type(trieupper)[0],
+        )
     with mkdir_and_open(crate, name) as f:
         write_header(f, name, comments)
         write_fmt(f, args, '''\
@@ -276,8 +612,7 @@ def generate_single_byte_index(opts, crate, name):
            |
            |const FORWARD_TABLE: &'static [u16] = &[
         ''')
-        write_comma_separated(f, '    ',
-            ['%s, ' % ('X' if value is None else value) for value in data])
+        write_comma_separated(f, '    ', ['X' if value is None else value for value in data])
         write_fmt(f, args, '''\
            |]; // {datasz} entries
            |
@@ -287,30 +622,81 @@ def generate_single_byte_index(opts, crate, name):
            |    FORWARD_TABLE[(code - 0x80) as usize]
            |}}
            |
-           |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
-           |const BACKWARD_TABLE_LOWER: &'static [u8] = &[
-        ''')
-        write_comma_separated(f, '    ',
-            ['%d, ' % (0 if v is None else v+0x80) for v in trielower])
-        write_fmt(f, args, '''\
-           |]; // {trielowersz} entries
-           |
-           |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
-           |const BACKWARD_TABLE_UPPER: &'static [u16] = &[
         ''')
-        write_comma_separated(f, '    ', ['%d, ' % v for v in trieupper])
+        if opts.phf_singlebyte:
+            write_fmt(f, args, '''\
+               |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
+               |const BACKWARD_PHF_SEEDS: &'static [u16] = &[
+            ''')
+            write_comma_separated(f, '    ', phfseeds)
+            write_fmt(f, args, '''\
+               |]; // {phfbucketsz} entries
+               |
+               |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
+               |const BACKWARD_PHF_KEYS: &'static [u16] = &[
+            ''')
+            write_comma_separated(f, '    ', ['X' if v is None else v for v in phfslots])
+            write_fmt(f, args, '''\
+               |]; // {phfslotsz} entries
+               |
+               |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
+               |const BACKWARD_PHF_VALUES: &'static [u8] = &[
+            ''')
+            write_comma_separated(f, '    ',
+                [0 if v is None else invdata[v]+0x80 for v in phfslots])
+            write_fmt(f, args, '''\
+               |]; // {phfslotsz} entries
+               |
+               |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
+               |#[inline]
+               |fn phf_hash(code: u32, seed: u32) -> u32 {{
+               |    // 32-bit FNV-1a over the little-endian bytes of `code`
+               |    let mut h = 0x811c9dc5 ^ seed;
+               |    h = (h ^ (code & 0xff)).wrapping_mul(0x01000193);
+               |    h = (h ^ ((code >> 8) & 0xff)).wrapping_mul(0x01000193);
+               |    h = (h ^ ((code >> 16) & 0xff)).wrapping_mul(0x01000193);
+               |    h = (h ^ (code >> 24)).wrapping_mul(0x01000193);
+               |    h
+               |}}
+               |
+               |/// Returns the index pointer for code point `code` in this index.
+               |#[inline]
+               |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
+               |pub fn backward(code: u32) -> u8 {{
+               |    let seed = BACKWARD_PHF_SEEDS[(phf_hash(code, 0) >> {phfbucketshift}) as usize];
+               |    let i = (phf_hash(code, seed as u32) >> {phfslotshift}) as usize;
+               |    // vacant slots have the key X, which is never a valid code point here
+               |    if BACKWARD_PHF_KEYS[i] as u32 == code {{ BACKWARD_PHF_VALUES[i] }} else {{ 0 }}
+               |}}
+               |
+            ''')
+        else:
+            write_fmt(f, args, '''\
+               |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
+               |const BACKWARD_TABLE_LOWER: &'static [u8] = &[
+            ''')
+            write_comma_separated(f, '    ', [0 if v is None else v+0x80 for v in trielower])
+            write_fmt(f, args, '''\
+               |]; // {trielowersz} entries
+               |
+               |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
+               |const BACKWARD_TABLE_UPPER: &'static [{trieuppertype}] = &[
+            ''')
+            write_comma_separated(f, '    ', trieupper)
+            write_fmt(f, args, '''\
+               |]; // {trieuppersz} entries
+               |
+               |/// Returns the index pointer for code point `code` in this index.
+               |#[inline]
+               |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
+               |pub fn backward(code: u32) -> u8 {{
+               |    let offset = (code >> {triebits}) as usize;
+               |    let offset = if offset < {trieuppersz} {{BACKWARD_TABLE_UPPER[offset] as usize}} else {{0}};
+               |    BACKWARD_TABLE_LOWER[offset + ((code & {triemask}) as usize)]
+               |}}
+               |
+            ''')
         write_fmt(f, args, '''\
-           |]; // {trieuppersz} entries
-           |
-           |/// Returns the index pointer for code point `code` in this index.
-           |#[inline]
-           |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
-           |pub fn backward(code: u32) -> u8 {{
-           |    let offset = (code >> {triebits}) as usize;
-           |    let offset = if offset < {trieuppersz} {{BACKWARD_TABLE_UPPER[offset] as usize}} else {{0}};
-           |    BACKWARD_TABLE_LOWER[offset + ((code & {triemask}) as usize)]
-           |}}
-           |
            |/// Returns the index pointer for code point `code` in this index.
            |#[cfg(feature = "no-optimized-legacy-encoding")]
            |pub fn backward(code: u32) -> u8 {{
@@ -328,7 +714,10 @@ def generate_single_byte_index(opts, crate, name):
         ''')
 
     forwardsz = 2 * len(data)
-    backwardsz = len(trielower) + 2 * len(trieupper)
+    if opts.phf_singlebyte:
+        backwardsz = 2 * len(phfseeds) + 3 * len(phfslots)
+    else:
+        backwardsz = len(trielower) + uint_type(trieupper)[1] * len(trieupper)
     return forwardsz, backwardsz, 0
 
 def generate_multi_byte_index(opts, crate, name):
@@ -480,35 +869,43 @@ def generate_multi_byte_index(opts, crate, name):
                |}
             ''')
 
+    # everything derived from the forward mapping is gathered in this single pass,
+    # so that neither `data` nor `premapped` has to be walked again afterwards.
     data = {}        # key => value
     invdata = {}     # (the first) value => key, with some exceptions
+    premapped = [None] * 0x10000 # premapped key => value
+    minkey = 0x10000 # the range of premapped keys
+    maxkey = 0
+    morekeys = []    # premapped keys whose values need SIP
     dups = []        # any value that is not mapped in invdata
     rawdups = []     # same to dups but a literal Rust code
     comments = []    # the comments in the index file
-    morebits = False # True if the mapping needs SIP
     for key, value in read_index(opts, crate, name, comments):
         assert 0 <= key < 0xffff and 0 <= value < 0x110000 and value != 0xffff and key not in data
+        pkey = premap(key)
+        assert pkey is not None and 0 <= pkey < 0x10000 and premapped[pkey] is None
         if value >= 0x10000:
             assert (value >> 16) == 2
-            morebits = True
+            morekeys.append(pkey)
         data[key] = value
+        premapped[pkey] = value
+        if pkey < minkey: minkey = pkey
+        if pkey >= maxkey: maxkey = pkey + 1
         if value not in invdata:
             invdata[value] = key
         else:
             dups.append(key)
 
     if name == 'big5':
-        # Big5 has four two-letter forward mappings, we use special entries for them
+        # Big5 has four two-letter forward mappings, we use special values for them.
+        # they are returned directly from `forward` and kept out of the tables.
         specialidx = [1133, 1135, 1164, 1166]
         assert all(key not in data for key in specialidx)
-        assert all(value not in invdata for value in xrange(len(specialidx)))
-        for value, key in enumerate(specialidx):
-            data[key] = value
-            dups.append(key) # no consistency testing for them
+        assert all(value not in invdata for value in range(len(specialidx)))
 
         # and HKSCS additions are entirely missing from the backward mapping
         hkscslimit = (0xa1 - 0x81) * 157
-        for value, key in invdata.items():
+        for value, key in list(invdata.items()):
             if key < hkscslimit: del invdata[value]
         rawdups.append('0...%d' % (hkscslimit - 1)) # no consistency testing for them
 
@@ -537,46 +934,61 @@ def generate_multi_byte_index(opts, crate, name):
         REMAP_MIN = 8272
         REMAP_MAX = 8835
 
-        invdataminusremap = {}
-        for key, value in data.items():
-            if value not in invdataminusremap and not REMAP_MIN <= key <= REMAP_MAX:
-                invdataminusremap[value] = key
-
-        remap = []
-        for i in xrange(REMAP_MIN, REMAP_MAX+1):
-            if i in data:
-                assert data[i] in invdataminusremap
-                value = invdataminusremap[data[i]]
-                assert value < 0x10000
-                remap.append(value)
-            else:
-                remap.append(0xffff)
-
-    newdata = {}
-    for key, value in data.items():
-        key = premap(key)
-        assert key is not None and 0 <= key < 0x10000 and key not in newdata
-        newdata[key] = value
-    data = newdata
-
-    # generate a trie and search index with a minimal amount of data
-    triebits, trielower, trieupper = make_minimal_trie(invdata, lowerlimit=0x10000)
-    searchbits, searchlower, searchupper = make_minimal_search(data, invdata, premap,
+        # the first key for each value, built in a single scan: walking `data` backwards
+        # lets earlier keys overwrite later ones, which a dict constructor does in C.
+        invdataminusremap = dict((value, key) for key, value in reversed(data.items())
+                                 if not REMAP_MIN <= key <= REMAP_MAX)
+
+        remap = [invdataminusremap[data[i]] if i in data else 0xffff
+                 for i in range(REMAP_MIN, REMAP_MAX+1)]
+        assert all(value < 0x10000 for value in remap)
+
+    # generate a trie (or an automaton) and search index with a minimal amount of data
+    if opts.dawg_multibyte:
+        dawgnibbits, dawgdepth, dawgnext, dawgvalues = make_dawg(invdata)
+        assert max(dawgnext) < 0x10000
+    else:
+        triebits, trielower, trieupper = make_minimal_trie(invdata, lowerlimit=0x10000,
+                                                           jobs=opts.jobs,
+                                                           cache_dir=opts.cache_dir,
+                                                           flush_cache=opts.flush_cache)
+    searchbits, searchlower, searchupper = make_minimal_search(premapped, minkey, invdata, premap,
             maxsearch=opts.max_backward_search_multibyte)
     # if the search degenerated to the full linear search, use a special code for them
     fulllinearsearch = (searchupper == [0, 1])
 
-    minkey = min(data)
-    maxkey = max(data) + 1
+    forward = [None if value is None else value & 0xffff for value in premapped[minkey:maxkey]]
+    morebits = bool(morekeys) # True if the mapping needs SIP
+    if morebits:
+        bits = [0] * ((maxkey - minkey + 31) // 32)
+        for key in morekeys:
+            bits[(key - minkey) >> 5] |= 1 << ((key - minkey) & 31)
+    forwardbin = use_binary_table(opts, forward)
+    lowerbin = use_binary_table(opts, dawgvalues if opts.dawg_multibyte else trielower)
+    if forwardbin:
+        forwardcode = 'read_u16(FORWARD_TABLE, code)'
+        forwardi = 'read_u16(FORWARD_TABLE, i as usize)'
+    else:
+        forwardcode = 'FORWARD_TABLE[code]'
+        forwardi = 'FORWARD_TABLE[i as usize]'
+    if opts.dawg_multibyte:
+        lowertable = 'BACKWARD_DAWG_VALUES'
+        lowerindex = 's + ((code & %d) as usize)' % ((1<<dawgnibbits)-1)
+    else:
+        lowertable = 'BACKWARD_TABLE_LOWER'
+        lowerindex = 'offset + ((code & %d) as usize)' % ((1<<triebits)-1)
+    if lowerbin:
+        lowerexpr = 'read_u16(%s, %s)' % (lowertable, lowerindex)
+    else:
+        lowerexpr = '%s[%s]' % (lowertable, lowerindex)
     args = dict(
         premapcode=premapcode,
+        forwardcode=forwardcode,
+        forwardi=forwardi,
+        lowerexpr=lowerexpr,
         maxvalue=max(invdata),
         dataoff=minkey,
         datasz=maxkey-minkey,
-        triebits=triebits,
-        triemask=(1<<triebits)-1,
-        trielowersz=len(trielower),
-        trieuppersz=len(trieupper),
         fulllinearsearch=fulllinearsearch,
         searchbits=searchbits,
         searchmask=(1<<searchbits)-1,
@@ -584,6 +996,22 @@ def generate_multi_byte_index(opts, crate, name):
         searchuppersz=len(searchupper),
         searchupperszm1=len(searchupper)-1,
     )
+    if opts.dawg_multibyte:
+        args.update(
+            dawgnibbits=dawgnibbits,
+            dawgnibmask=(1<<dawgnibbits)-1,
+            dawgbits=dawgnibbits*dawgdepth,
+            dawgtopshift=dawgnibbits*(dawgdepth-1),
+            dawgnextsz=len(dawgnext),
+        )
+    else:
+        args.update(
+            triebits=triebits,
+            triemask=(1<<triebits)-1,
+            trielowersz=len(trielower),
+            trieuppersz=len(trieupper),
+            trieuppertype=uint_type(trieupper)[0],
+        )
     if remap:
         args.update(
             remapsz=len(remap),
@@ -595,27 +1023,26 @@ def generate_multi_byte_index(opts, crate, name):
         write_fmt(f, args, '''\
            |
            |#[allow(dead_code)] const X: u16 = 0xffff;
-           |{premapcode}
-           |const FORWARD_TABLE: &'static [u16] = &[
         ''')
-        write_comma_separated(f, '    ',
-            ['%s, ' % (data[key] & 0xffff if key in data else 'X')
-             for key in xrange(minkey, maxkey)])
+        write_fmt(f, args, forwardbin or lowerbin, '''\
+           |
+           |/// Reads the `i`-th entry of a binary table of little-endian `u16`s.
+           |#[allow(dead_code)]
+           |#[inline]
+           |fn read_u16(table: &'static [u8], i: usize) -> u16 {{
+           |    (table[i * 2] as u16) | ((table[i * 2 + 1] as u16) << 8)
+           |}}
+        ''')
         write_fmt(f, args, '''\
-           |]; // {datasz} entries
+           |{premapcode}
         ''')
+        write_u16_table(f, crate, name, 'FORWARD_TABLE', forward, forwardbin)
         if morebits:
-            bits = []
-            for i in xrange(minkey, maxkey, 32):
-                v = 0
-                for j in xrange(32):
-                    v |= (data.get(i+j, 0) >= 0x10000) << j
-                bits.append(v)
             write_fmt(f, args, '''\
                |
                |const FORWARD_TABLE_MORE: &'static [u32] = &[
             ''')
-            write_comma_separated(f, '    ', ['%d, ' % v for v in bits])
+            write_comma_separated(f, '    ', bits)
             write_fmt(f, args, '''\
                |]; // {moresz} entries
             ''',
@@ -626,6 +1053,12 @@ def generate_multi_byte_index(opts, crate, name):
            |#[inline]
            |pub fn forward(code: u16) -> u32 {{
         ''')
+        if name == 'big5':
+            for value, key in enumerate(specialidx):
+                write_fmt(f, args, '''\
+                   |    if code == {key} {{ return {value}; }}
+                ''',
+                    key=key, value=value)
         write_fmt(f, args, premapcode, '''\
            |    let code = premap_forward(code);
         ''')
@@ -638,9 +1071,9 @@ def generate_multi_byte_index(opts, crate, name):
            |    if code < {datasz} {{
         ''')
         write_fmt(f, args, morebits, '''\
-           |        (FORWARD_TABLE[code] as u32) | (((FORWARD_TABLE_MORE[code >> 5] >> (code & 31)) & 1) << 17)
+           |        ({forwardcode} as u32) | (((FORWARD_TABLE_MORE[code >> 5] >> (code & 31)) & 1) << 17)
         ''', '''\
-           |        FORWARD_TABLE[code] as u32
+           |        {forwardcode} as u32
         ''')
         write_fmt(f, args, '''\
            |    }} else {{
@@ -648,21 +1081,33 @@ def generate_multi_byte_index(opts, crate, name):
            |    }}
            |}}
            |
-           |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
-           |const BACKWARD_TABLE_LOWER: &'static [u16] = &[
-        ''')
-        write_comma_separated(f, '    ',
-            ['%s, ' % ('X' if v is None else v) for v in trielower])
-        write_fmt(f, args, '''\
-           |]; // {trielowersz} entries
-           |
-           |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
-           |const BACKWARD_TABLE_UPPER: &'static [u16] = &[
-        ''')
-        write_comma_separated(f, '    ', ['%d, ' % v for v in trieupper])
-        write_fmt(f, args, '''\
-           |]; // {trieuppersz} entries
         ''')
+        if opts.dawg_multibyte:
+            remove_binary_table(crate, name, 'BACKWARD_TABLE_LOWER')
+            write_u16_table(f, crate, name, 'BACKWARD_DAWG_VALUES', dawgvalues, lowerbin,
+                            attrs='#[cfg(not(feature = "no-optimized-legacy-encoding"))]\n')
+            write_fmt(f, args, '''\
+               |
+               |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
+               |const BACKWARD_DAWG_NEXT: &'static [u16] = &[
+            ''')
+            write_comma_separated(f, '    ', dawgnext)
+            write_fmt(f, args, '''\
+               |]; // {dawgnextsz} entries
+            ''')
+        else:
+            remove_binary_table(crate, name, 'BACKWARD_DAWG_VALUES')
+            write_u16_table(f, crate, name, 'BACKWARD_TABLE_LOWER', trielower, lowerbin,
+                            attrs='#[cfg(not(feature = "no-optimized-legacy-encoding"))]\n')
+            write_fmt(f, args, '''\
+               |
+               |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
+               |const BACKWARD_TABLE_UPPER: &'static [{trieuppertype}] = &[
+            ''')
+            write_comma_separated(f, '    ', trieupper)
+            write_fmt(f, args, '''\
+               |]; // {trieuppersz} entries
+            ''')
         if not fulllinearsearch:
             write_fmt(f, args, '''\
                |
@@ -670,14 +1115,14 @@ def generate_multi_byte_index(opts, crate, name):
                |const BACKWARD_SEARCH_LOWER: &'static [(u16, u16)] = &[
             ''')
             write_comma_separated(f, '    ',
-                ['(%d, %d), ' % (lo, hi) for lo, hi in searchlower])
+                ['(%d, %d)' % (lo, hi) for lo, hi in searchlower])
             write_fmt(f, args, '''\
                |]; // {searchlowersz} entries
                |
                |#[cfg(feature = "no-optimized-legacy-encoding")]
                |const BACKWARD_SEARCH_UPPER: &'static [u16] = &[
             ''')
-            write_comma_separated(f, '    ', ['%d, ' % v for v in searchupper])
+            write_comma_separated(f, '    ', searchupper)
             write_fmt(f, args, '''\
                |]; // {searchuppersz} entries
             ''')
@@ -686,11 +1131,30 @@ def generate_multi_byte_index(opts, crate, name):
                |
                |const BACKWARD_TABLE_REMAPPED: &'static [u16] = &[
             ''')
-            write_comma_separated(f, '    ', ['%d, ' % v for v in remap])
+            write_comma_separated(f, '    ', remap)
             write_fmt(f, args, '''\
                |]; // {remapsz} entries
             ''')
-        write_fmt(f, args, '''\
+        write_fmt(f, args, opts.dawg_multibyte, '''\
+           |
+           |/// Returns the index pointer for code point `code` in this index.
+           |#[inline]
+           |#[cfg(not(feature = "no-optimized-legacy-encoding"))]
+           |pub fn backward(code: u32) -> u16 {{
+           |    if (code >> {dawgbits}) != 0 {{ return X; }}
+           |    // walk the automaton from the root (at 0) {dawgnibbits} bits at a time,
+           |    // where the last {dawgnibbits} bits index the leaf block of values.
+           |    let mut s = 0;
+           |    let mut shift = {dawgtopshift};
+           |    while shift > 0 {{
+           |        s = BACKWARD_DAWG_NEXT[s + ((code >> shift) & {dawgnibmask}) as usize] as usize;
+           |        shift -= {dawgnibbits};
+           |    }}
+           |    // BACKWARD_DAWG_VALUES stores the actual (pre-mapped) value
+           |    // so we don't have to call premap_backward here.
+           |    {lowerexpr}
+           |}}
+        ''', '''\
            |
            |/// Returns the index pointer for code point `code` in this index.
            |#[inline]
@@ -700,8 +1164,10 @@ def generate_multi_byte_index(opts, crate, name):
            |    let offset = if offset < {trieuppersz} {{BACKWARD_TABLE_UPPER[offset] as usize}} else {{0}};
            |    // BACKWARD_TABLE_LOWER stores the actual (pre-mapped) value
            |    // so we don't have to call premap_backward here.
-           |    BACKWARD_TABLE_LOWER[offset + ((code & {triemask}) as usize)]
+           |    {lowerexpr}
            |}}
+        ''')
+        write_fmt(f, args, '''\
            |
            |/// Returns the index pointer for code point `code` in this index.
            |#[cfg(feature = "no-optimized-legacy-encoding")]
@@ -737,13 +1203,21 @@ def generate_multi_byte_index(opts, crate, name):
            |            }}
            |        }} else {{
            |            for i in s..e {{
-           |                if FORWARD_TABLE[i as usize] == codelo {{
+           |                if {forwardi} == codelo {{
            |                    ''' + (retifcorrect % 'i') + '''
            |                }}
            |            }}
            |        }}
            |    }}
         ''', '''\
+           |    if code <= {maxvalue} {{
+           |        for i in 0..{datasz} {{
+           |            if read_u16(FORWARD_TABLE, i) == codelo {{
+           |                ''' + (retifcorrect % 'i as u16') + '''
+           |            }}
+           |        }}
+           |    }}
+        ''' if forwardbin else '''\
            |    if code <= {maxvalue} {{
            |        for (i, &v) in FORWARD_TABLE.iter().enumerate() {{
            |            if v == codelo {{
@@ -781,7 +1255,7 @@ def generate_multi_byte_index(opts, crate, name):
             write_fmt(f, args, '''\
                |    dups = [
             ''')
-            write_comma_separated(f, '        ', ['%s, ' % v for v in rawdups] + ['%d, ' % v for v in sorted(dups)])
+            write_comma_separated(f, '        ', rawdups + sorted(dups))
             write_fmt(f, args, '''\
                |    ]
             ''')
@@ -794,7 +1268,10 @@ def generate_multi_byte_index(opts, crate, name):
         ''')
 
     forwardsz = 2 * (maxkey - minkey)
-    backwardsz = 2 * len(trielower) + 2 * len(trieupper)
+    if opts.dawg_multibyte:
+        backwardsz = 2 * len(dawgvalues) + 2 * len(dawgnext)
+    else:
+        backwardsz = 2 * len(trielower) + uint_type(trieupper)[1] * len(trieupper)
     backwardszslow = 2 * len(searchlower) + 4 * len(searchupper)
     backwardmore = 0
     if morebits: backwardmore += 4 * ((maxkey - minkey + 31) // 32)
@@ -838,27 +1315,30 @@ def generate_multi_byte_range_lbound_index(opts, crate, name):
            |
            |const FORWARD_TABLE: &'static [u32] = &[
         ''')
-        write_comma_separated(f, '    ', ['%d, ' % value for key, value in data])
+        write_comma_separated(f, '    ', [value for key, value in data])
         write_fmt(f, args, '''\
            |]; // {datasz} entries
            |
            |const BACKWARD_TABLE: &'static [u32] = &[
         ''')
-        write_comma_separated(f, '    ', ['%d, ' % key for key, value in data])
+        write_comma_separated(f, '    ', [key for key, value in data])
         write_fmt(f, args, '''\
            |]; // {datasz} entries
            |
+           |#[inline(always)]
            |fn search(code: u32, fromtab: &'static [u32], totab: &'static [u32]) -> u32 {{
-           |    let mut i = if code >= fromtab[{firstoff}] {{{firstdelta}}} else {{0}};
+           |    // a branchless binary search; each comparison is turned into
+           |    // a conditional increment of `i` rather than a branch.
+           |    let mut i = ((code >= fromtab[{firstoff}]) as usize) * {firstdelta};
         ''',
             firstoff=2**maxlog2 - 1,
             firstdelta=len(data) - 2**maxlog2 + 1)
-        for i in xrange(maxlog2-1, -1, -1):
+        for i in range(maxlog2-1, -1, -1):
             write_fmt(f, args, '''\
-               |    if code >= fromtab[i{plusoff}] {{ i += {delta}; }}
+               |    i += {incr};
             ''',
-                plusoff='+%d' % (2**i-1) if i > 0 else '',
-                delta=2**i)
+                incr='((code >= fromtab[i+%d]) as usize) << %d' % (2**i-1, i) if i > 0 else
+                     '(code >= fromtab[i]) as usize')
         write_fmt(f, args, '''\
            |    (code - fromtab[i-1]) + totab[i-1]
            |}}
@@ -948,10 +1428,10 @@ INDICES = [
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--flush-cache', action='store_true',
-                        help='flush the download cache')
+                        help='ignore the download and trie caches and always regenerate them')
     parser.add_argument('--cache-dir',
                         default=os.path.join(os.path.dirname(sys.argv[0]), '.cache'),
-                        help='set the download cache directory [default: %(default)s]')
+                        help='set the download and trie cache directory [default: %(default)s]')
     parser.add_argument('--singlebyte', dest='func_filter', action='store_const',
                         const=generate_single_byte_index,
                         help='generate only single-byte indices')
@@ -964,23 +1444,36 @@ def main():
                              'for multi-byte indices [default: %(default)s]\n')
     parser.add_argument('--no-premapping', action='store_true',
                         help='disable premapping; trades table size for decoder performance')
+    parser.add_argument('--phf-singlebyte', action='store_true',
+                        help='use a perfect hash instead of a trie for the backward mapping '
+                             'of single-byte indices')
+    parser.add_argument('--dawg-multibyte', action='store_true',
+                        help='use a minimized automaton instead of a trie for the backward '
+                             'mapping of multi-byte indices')
+    parser.add_argument('--text-tables', action='store_true',
+                        help='emit large tables as Rust source instead of separate binary files')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='set the number of worker processes for the trie search; '
+                             'the pruned search is usually fast enough without them '
+                             '[default: %(default)s]')
     parser.add_argument('filters', nargs='*',
                         help='substring of indices to regenerate')
     opts = parser.parse_args()
+    opts.offline = False # set when fetching an index fails for network reasons
 
     totalsz = totalszslow = 0
     for index, generate in INDICES:
         crate, _, index = index.partition('/')
         if opts.filters and all(s not in index for s in opts.filters): continue
         if opts.func_filter and generate is not opts.func_filter: continue
-        print >>sys.stderr, 'generating index %s...' % index,
+        print('generating index %s...' % index, end=' ', file=sys.stderr, flush=True)
         forwardsz, backwardsz, backwardszslow = generate(opts, crate, index)
         totalsz += forwardsz + backwardsz
         totalszslow += forwardsz + backwardszslow
-        print >>sys.stderr, '%d + %d (%d) = %d (%d) bytes.' % \
+        print('%d + %d (%d) = %d (%d) bytes.' %
                 (forwardsz, backwardsz, backwardszslow,
-                 forwardsz + backwardsz, forwardsz + backwardszslow)
-    print >>sys.stderr, 'total %d (%d) bytes.' % (totalsz, totalszslow)
+                 forwardsz + backwardsz, forwardsz + backwardszslow), file=sys.stderr)
+    print('total %d (%d) bytes.' % (totalsz, totalszslow), file=sys.stderr)
 
 if __name__ == '__main__':
     main()